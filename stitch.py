@@ -11,63 +11,88 @@
 # this program. If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import contextlib
+import errno
+import functools
+import mmap
+import os
+import queue
+import re
 import shutil
+import stat
 import struct
 import sys
-import zlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 
+# zlib-ng and isa-l are both drop-ins for zlib (same streams and api) but a good
+# bit faster, using simd for the checksums and match finding. so use them if
+# they're installed.
+try:
+    from zlib_ng import zlib_ng as zlib
+except ImportError:
+    try:
+        from isal import isal_zlib as zlib
+    except ImportError:
+        import zlib
 
-
-# Turns the given class into a singleton, instantiating it once.
-def singleton(cls):
-    instance = cls()
-    def throw(*args, **kwargs):
-        msg = f"cannot create another instance of singleton '{cls.__name__}'"
-        raise TypeError(msg)
-    cls.__new__ = throw
-    return instance
+# zstandard is an optional alternative codec, only needed if asked for.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 
 # Queries the user for a yes or no response.
-@singleton
-class ask:
-    _always_yes = False
-    NONE = 0 # not in a context.
-    NO = 1 # in a context, without always saying yes.
-    YES = 2 # in a context, always saying yes.
-    _ctx = NONE
-
-    def __call__(self, query):
-        options = "(y/n/a)" if self._ctx else "(y/n)"
-        print(f"{query} {options}: ", end="")
-        if self._always_yes or self._ctx == self.YES:
-            print("y")
+ASK_NONE = 0 # not in a context.
+ASK_NO = 1 # in a context, without always saying yes.
+ASK_YES = 2 # in a context, always saying yes.
+_ask_always_yes = False
+_ask_ctx = ASK_NONE
+
+def ask(query):
+    global _ask_ctx
+    options = "(y/n/a)" if _ask_ctx else "(y/n)"
+    print(f"{query} {options}: ", end="")
+    if _ask_always_yes or _ask_ctx == ASK_YES:
+        print("y")
+        return True
+    while True:
+        user_input = input().strip().casefold()
+        if user_input == "y":
+            return True
+        if user_input == "n":
+            return False
+        if _ask_ctx and user_input == "a":
+            _ask_ctx = ASK_YES
             return True
-        while True:
-            user_input = input().strip().casefold()
-            if user_input == "y":
-                return True
-            if user_input == "n":
-                return False
-            if self._ctx and user_input == "a":
-                self._ctx = self.YES
-                return True
 
-    def always_yes(self):
-        self._always_yes = True
+def ask_always_yes():
+    global _ask_always_yes
+    _ask_always_yes = True
+
+# Context within which the user may answer "a" to say yes to all the remaining
+# queries.
+@contextlib.contextmanager
+def ask_context():
+    global _ask_ctx
+    if _ask_ctx:
+        raise Exception("already in 'ask' context")
+    _ask_ctx = ASK_NO
+    try:
+        yield
+    finally:
+        _ask_ctx = ASK_NONE
 
-    def __enter__(self):
-        if self._ctx:
-            raise Exception("already in 'ask' context")
-        self._ctx = self.NO
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        if not self._ctx:
-            raise Exception("not in 'ask' context")
-        self._ctx = self.NONE
+
+# Stand-in for `print` when output is disabled.
+def noop(*args, **kwargs):
+    pass
 
 
 
@@ -94,30 +119,32 @@ def pathlist(paths):
     return ", ".join(map(esc, paths))
 
 
-def validate_filename(filename, only_valid_windows):
-    # https://stackoverflow.com/a/31976060
+# https://stackoverflow.com/a/31976060
+# Translation tables to replace the invalid characters in a filename. most
+# control codes are valid on unix but i dont wanna create a file which is
+# insanely difficult to remove/access.
+UNIX_REPLACE = str.maketrans({chr(i): "_" for i in range(32)} | {"/": "_"})
+WINDOWS_REPLACE = str.maketrans({chr(i): "_" for i in range(32)}
+        | {c: "_" for c in "<>:\"/\\|?*"})
+WINDOWS_ILLEGAL_NAMES = {"con", "prn", "aux", "nul"}
+WINDOWS_ILLEGAL_NAMES |= {f"com{i}" for i in range(1, 10)}
+WINDOWS_ILLEGAL_NAMES |= {f"lpt{i}" for i in range(1, 10)}
 
+def validate_filename(filename, only_valid_windows):
     DFLT = "file"
 
-    # most control codes are valid on unix but i dont wanna create a file which
-    # is insanely difficult to remove/access.
-    replace = {chr(i) for i in range(32)}
-    replace |= {"/"}
     if only_valid_windows:
-        replace |= {"<", ">", ":", "\"", "/", "\\", "|", "?", "*"}
-    for char in replace:
-        filename = filename.replace(char, "_")
+        filename = filename.translate(WINDOWS_REPLACE)
+    else:
+        filename = filename.translate(UNIX_REPLACE)
 
     if only_valid_windows:
         if filename.endswith(" ") or filename.endswith("."):
             filename = filename[:-1] + "_"
 
     if only_valid_windows:
-        illegal_names = {"con", "prn", "aux", "nul"}
-        illegal_names |= {f"com{i}" for i in range(1, 10)}
-        illegal_names |= {f"lpt{i}" for i in range(1, 10)}
         name = filename.split(".", 1)[0]
-        if name.casefold() in illegal_names:
+        if name.casefold() in WINDOWS_ILLEGAL_NAMES:
             return DFLT
 
     # the so answer doesnt say this is invalid on windows but like. come on. how
@@ -128,25 +155,38 @@ def validate_filename(filename, only_valid_windows):
     return filename
 
 
+# Yields the paths which don't refer to an already seen file.
 def unique_paths(paths):
+    # resolving walks every component of the path, so cache the parents since
+    # most paths share them. then only a symlink at the end needs the full walk.
+    resolve_parent = functools.cache(lambda parent: parent.resolve())
     seen = set()
-    unique = []
     for path in paths:
-        abspath = path.resolve()
+        path = Path(path)
+        if path.name in {"", ".."} or path.is_symlink():
+            abspath = path.resolve()
+        else:
+            abspath = resolve_parent(path.parent) / path.name
+        abspath = str(abspath) # quicker to hash.
         if abspath in seen:
             continue
         seen.add(abspath)
-        unique.append(path)
-    return unique
+        yield path
 
 
 def delete_paths(*paths):
     exceptions = []
     for path in paths:
+        # just try to delete it as a file, since that's the common case.
         try:
-            if path.is_file():
-                path.unlink()
-            elif path.is_dir():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except (IsADirectoryError, PermissionError):
+                # note windows and mac give a permission error for directories.
+                if not os.path.isdir(path):
+                    raise
                 shutil.rmtree(path)
         except Exception as e:
             exceptions.append((path, str(e)))
@@ -177,6 +217,11 @@ def create_empty_dir(path):
 
 
 def open_for_write(path):
+    # only check for overwriting if the exclusive create fails.
+    try:
+        return path.open("xb")
+    except FileExistsError:
+        pass
     if not ensure_empty(path):
         error(f"cannot create file at: {esc(path)}")
     return path.open("wb")
@@ -190,21 +235,165 @@ class NoExiste:
 NO_EXISTE = NoExiste()
 
 def open_for_read(path, ignorable=True, askable=True):
-    fine = True
+    # just try it, rather than checking the path first (which costs more
+    # syscalls, for the rare case). unbuffered since it's only ever read in
+    # big chunks (or mapped), which a buffer would just add a copy to.
+    try:
+        return path.open("rb", buffering=0)
+    except FileNotFoundError:
+        query = f"file {esc(path)} doesn't exist, ignore?"
+    except OSError:
+        # note windows gives a permission error for directories.
+        if path.is_file():
+            raise
+        query = f"path {esc(path)} is not a file, ignore?"
     ignore = ignorable
-    if not path.exists():
-        fine = False
-        if ignorable and askable:
-            ignore = ask(f"file {esc(path)} doesn't exist, ignore?")
-    elif not path.is_file():
-        fine = False
-        if ignorable and askable:
-            ignore = ask(f"path {esc(path)} is not a file, ignore?")
-    if not fine:
-        if ignore:
-            return NO_EXISTE
-        error(f"file doesn't exist at: {esc(path)}")
-    return path.open("rb")
+    if ignorable and askable:
+        ignore = ask(query)
+    if ignore:
+        return NO_EXISTE
+    error(f"file doesn't exist at: {esc(path)}")
+
+
+# Reads only the header of a section file. Skips the buffered file object, which
+# would read-ahead far more than we need.
+def read_header(path):
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        return os.read(fd, Header.SIZE)
+    finally:
+        os.close(fd)
+
+
+# Ways to have the kernel copy between files directly, without it passing through
+# our memory. Each copies from the src fd at the offset to the dst fd's current
+# position, returning how many bytes were copied.
+KERNEL_COPIES = []
+if hasattr(os, "copy_file_range"):
+    KERNEL_COPIES.append(lambda src, dst, offset, count:
+            os.copy_file_range(src, dst, count, offset))
+if hasattr(os, "sendfile"):
+    KERNEL_COPIES.append(lambda src, dst, offset, count:
+            os.sendfile(dst, src, offset, count))
+# errors for when a kernel copy isn't supported for these files.
+NO_KERNEL_COPY = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP,
+        errno.EOPNOTSUPP, errno.ENOTSOCK}
+
+# Appends `size` bytes of `src` from `offset` to `dst`.
+def copy_range(dst, src, offset, size):
+    end = offset + size
+    dst.flush()
+    for copy in KERNEL_COPIES:
+        try:
+            while offset < end:
+                copied = copy(src.fileno(), dst.fileno(), offset, end - offset)
+                if not copied:
+                    break
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in NO_KERNEL_COPY:
+                raise
+    # fallback to a plain copy, picking up from wherever it got to.
+    src.seek(offset)
+    while offset < end:
+        buf = src.read(min(CHUNK, end - offset))
+        if not buf:
+            break
+        dst.write(buf)
+        offset += len(buf)
+
+
+# Iterates the given generator on a separate thread (starting immediately),
+# keeping up to `depth` items ready ahead of the consumer. Exceptions are
+# re-raised to the consumer. Must be closed if not exhausted.
+class Prefetch:
+    def __init__(self, gen, depth):
+        self.items = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(gen,),
+                daemon=True)
+        self.thread.start()
+
+    def run(self, gen):
+        with contextlib.closing(gen):
+            try:
+                for item in gen:
+                    self.items.put((item, None))
+                    if self.stop.is_set():
+                        return
+            except BaseException as e:
+                self.items.put((None, e))
+                return
+        self.items.put((None, StopIteration()))
+
+    def __iter__(self):
+        while True:
+            item, e = self.items.get()
+            if isinstance(e, StopIteration):
+                return
+            if e is not None:
+                raise e
+            yield item
+
+    def close(self):
+        # stop it, making sure it's not left blocked on a full queue.
+        self.stop.set()
+        while self.thread.is_alive():
+            try:
+                self.items.get(timeout=0.01)
+            except queue.Empty:
+                pass
+
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+
+
+# Reads across the given buffers as if they were one file, only pulling the next
+# buffer from the iterable once it's needed.
+class JoinedReader:
+    def __init__(self, bufs):
+        self.bufs = iter(bufs)
+        self.ready = deque() # pulled but not yet read.
+
+    # Pulls buffers until at-least `size` bytes are ready (or there's no more).
+    def pull(self, size):
+        have = sum(map(len, self.ready))
+        while have < size and (buf := next(self.bufs, None)) is not None:
+            if buf:
+                self.ready.append(buf)
+                have += len(buf)
+
+    # Returns up to the next `size` bytes without reading them.
+    def peek(self, size):
+        self.pull(size)
+        out = bytearray()
+        for buf in self.ready:
+            out += buf[:size - len(out)]
+        return bytes(out)
+
+    # Returns up to the next `size` bytes, from within a single buffer.
+    def read(self, size=-1):
+        self.pull(1)
+        if not self.ready:
+            return b""
+        buf = self.ready.popleft()
+        if 0 <= size < len(buf):
+            self.ready.appendleft(buf[size:])
+            buf = buf[:size]
+        return buf
+
+    # Reads and discards the next `size` bytes, returning whether there were
+    # that many.
+    def skip(self, size):
+        while size and (buf := self.read(size)):
+            size -= len(buf)
+        return not size
 
 
 
@@ -215,21 +404,34 @@ EXT = ".brs"
 # Section file header:
 #   offset  length  desc
 #   0       3       magic "BRS"
-#   3       1       flags ([0] = is last, [1] = compressed)
+#   3       1       flags ([0] = is last, [1] = compressed, [2] = synced,
+#                   [3] = zstandard)
 #   4       4       u32 section index
 #   8       120     string of original file name (including og extension).
 # 128 byte total.
-@dataclass
+# A synced section's compressed data starts on a deflate block which doesn't
+# refer back into any earlier section, so it can be decompressed on its own.
+# Compressed sections are zlib unless marked as zstandard.
+# Older versions reject sections marked synced or zstandard, so they can't
+# stitch zstandard files or compressed files which were cut early on a block.
+@dataclass(slots=True)
 class Header:
     SIZE = 128
     MAGIC = b"BRS"
     FLAG_LAST = 0x01
     FLAG_COMP = 0x02
+    FLAG_SYNC = 0x04
+    FLAG_ZSTD = 0x08
+    NAME_SIZE = SIZE - 8
+    # the whole header, precompiled to pack/unpack in one go.
+    LAYOUT = struct.Struct(f"<3sBI{NAME_SIZE}s")
 
     name: str
     index: int
     comp: bool
     last: bool
+    sync: bool = False
+    zstd: bool = False
     def __post_init__(self):
         if not (0 <= self.index < 2**32):
             raise ValueError("index must be a 4B unsigned integer")
@@ -239,19 +441,25 @@ class Header:
         if len(buf) != cls.SIZE:
             raise ValueError("header must be 128B")
 
-        if buf[:3] != cls.MAGIC:
+        magic, flags, index, name = cls.LAYOUT.unpack(buf)
+
+        if magic != cls.MAGIC:
             raise ValueError("incorrect magic number")
 
-        flags = buf[3]
-        if flags & ~(cls.FLAG_LAST | cls.FLAG_COMP):
+        if flags & ~(cls.FLAG_LAST | cls.FLAG_COMP | cls.FLAG_SYNC
+                | cls.FLAG_ZSTD):
+            raise ValueError("invalid flags")
+        if (flags & cls.FLAG_ZSTD) and not (flags & cls.FLAG_COMP):
             raise ValueError("invalid flags")
 
-        index, = struct.unpack_from("<I", buf, 4)
-        name = buf[8:].rstrip(b"\x00").decode("utf-8")
+        name = name.rstrip(b"\x00").decode("utf-8")
 
         comp = (flags & cls.FLAG_COMP) > 0
         last = (flags & cls.FLAG_LAST) > 0
-        return cls(name=name, index=index, comp=comp, last=last)
+        sync = (flags & cls.FLAG_SYNC) > 0
+        zstd = (flags & cls.FLAG_ZSTD) > 0
+        return cls(name=name, index=index, comp=comp, last=last, sync=sync,
+                zstd=zstd)
 
     def write(self):
         flags = 0
@@ -259,83 +467,436 @@ class Header:
             flags |= self.FLAG_COMP
         if self.last:
             flags |= self.FLAG_LAST
-        flags = bytes([flags])
+        if self.sync:
+            flags |= self.FLAG_SYNC
+        if self.zstd:
+            flags |= self.FLAG_ZSTD
 
-        index = struct.pack("<I", self.index)
-        NAMESZ = self.SIZE - 8
-        name = self.name.encode("utf-8")[:NAMESZ].ljust(NAMESZ, b"\x00")
+        name = self.pack_name(self.name)
+        return self.LAYOUT.pack(self.MAGIC, flags, self.index, name)
 
-        return self.MAGIC + flags + index + name
+    # cached since every section of a file has the same name.
+    @staticmethod
+    @functools.cache
+    def pack_name(name):
+        name = name.encode("utf-8")[:Header.NAME_SIZE]
+        return name.ljust(Header.NAME_SIZE, b"\x00")
 
 
 
 
 # All read/write operations are this size. Note this is entirely independant from
 # section file sizing, this is just so that we can stitch files which we may not
-# be able to hold in ram all at once.
-CHUNK = 50 << 20 # 50mB
-
-
-def chunkify(file, compress, max_size, process):
+# be able to hold in ram all at once. Large enough to amortise the per-chunk
+# overhead, but small enough to stay cache-friendly. Can be overridden by the
+# "STITCH_CHUNK" environment variable (in bytes), which `main` rejects if it's
+# not a positive number.
+try:
+    CHUNK = int(os.environ.get("STITCH_CHUNK", 1 << 20)) # 1mB
+except ValueError:
+    CHUNK = 0
+
+
+# A section is ended early on a block boundary (so that the next section can be
+# synced) if that would leave at most 1/SYNC_SLACK of it unused.
+SYNC_SLACK = 32
+
+
+# Returns the adler32 checksum of two pieces of data joined together, given the
+# checksum of each and the length of the second. This is zlib's
+# `adler32_combine`, which python doesn't expose.
+def adler32_combine(adler1, adler2, size2):
+    BASE = 65521
+    # each byte of the second piece gets the first's sum added to its running
+    # total, less the starting 1 which both sums include.
+    sum1 = (adler1 & 0xFFFF) + (adler2 & 0xFFFF) - 1
+    sum2 = (adler1 >> 16) + (adler2 >> 16) + size2 * ((adler1 & 0xFFFF) - 1)
+    return (sum1 % BASE) | ((sum2 % BASE) << 16)
+
+
+# Compresses a single stream across all cores, pigz style. The input is cut into
+# blocks which are each deflated on their own (primed with the tail of the
+# previous block, so there's barely any ratio lost) and sync flushed onto a byte
+# boundary, meaning the raw blocks can just be concatenated. Between the zlib
+# header and trailer, the blocks make a normal zlib stream. Must be closed.
+class ParallelCompressor:
+    BLOCK = 128 << 10 # 128kB
+    WINDOW = 32 << 10 # 32kB, the deflate window.
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.level = level
+        self.workers = os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.jobs = deque() # (block, future) in order.
+        self.pending = bytearray() # start of the next block.
+        self.dictionary = None # tail of the previous block.
+        self.adler = zlib.adler32(b"")
+        # only the (two byte) header from an empty stream.
+        self.header = zlib.compressobj(level).flush()[:2]
+
+    # Note zlib releases the gil while compressing, so these run in parallel.
+    @staticmethod
+    def compress_block(block, level, dictionary=None):
+        kwargs = {} if dictionary is None else {"zdict": dictionary}
+        # max memlevel, the bigger hash table is both faster and smaller.
+        co = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9,
+                **kwargs)
+        return co.compress(block) + co.flush(zlib.Z_SYNC_FLUSH)
+
+    # Compresses the block and also takes its checksum, so that's done on the
+    # workers too.
+    @classmethod
+    def job(cls, block, level, dictionary):
+        return cls.compress_block(block, level, dictionary), zlib.adler32(block)
+
+    # Recompresses the given block without priming it, so that it (and the rest
+    # of the stream after it) doesn't refer back to anything before it.
+    def unprimed(self, block):
+        return self.compress_block(block, self.level)
+
+    def submit(self, block, out):
+        self.jobs.append((block, self.pool.submit(self.job, block, self.level,
+                self.dictionary)))
+        self.dictionary = block[-self.WINDOW:]
+        # bound the blocks held in memory, while keeping all workers fed.
+        while len(self.jobs) > 2 * self.workers:
+            self.collect(out)
+
+    def collect(self, out):
+        block, future = self.jobs.popleft()
+        compressed, adler = future.result()
+        self.adler = adler32_combine(self.adler, adler, len(block))
+        out.append((block, compressed))
+
+    # Returns a list of the compressed blocks which are ready, as tuples of
+    # (input, output).
+    def compress(self, data):
+        out = []
+        view = memoryview(data)
+        # complete the partial block first.
+        if self.pending:
+            need = self.BLOCK - len(self.pending)
+            self.pending += view[:need]
+            view = view[need:]
+            if len(self.pending) < self.BLOCK:
+                return out
+            self.submit(bytes(self.pending), out)
+            self.pending.clear()
+        while len(view) >= self.BLOCK:
+            self.submit(bytes(view[:self.BLOCK]), out)
+            view = view[self.BLOCK:]
+        self.pending += view
+        return out
+
+    # Returns all remaining compressed blocks, same as `compress`.
+    def flush(self):
+        out = []
+        if self.pending:
+            self.submit(bytes(self.pending), out)
+            self.pending.clear()
+        while self.jobs:
+            self.collect(out)
+        return out
+
+    # Returns the end of the stream, an empty final block and the checksum of all
+    # the input. Only valid after flushing.
+    def trailer(self):
+        final = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return final.flush() + struct.pack(">I", self.adler)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+# Compresses a single zstandard stream, with the same interface as
+# `ParallelCompressor`. zstandard does its own multithreading. There are no
+# blocks that a section can be synced on, so all the output is given without its
+# input. Must be closed.
+class ZstdCompressor:
+    header = b""
+
+    # The size of the input is recorded in the stream if given, which is then
+    # also checked when decompressing.
+    def __init__(self, level, size=-1):
+        compressor = zstandard.ZstdCompressor(level=level, write_checksum=True,
+                threads=-1)
+        self.compressor = compressor.compressobj(size=size)
+
+    def compress(self, data):
+        return [(None, self.compressor.compress(data))]
+
+    def flush(self):
+        return [(None, self.compressor.flush())]
+
+    def trailer(self):
+        return b""
+
+    def close(self):
+        pass
+
+
+# Splits the file into sections of up to `max_size` bytes, streaming each piece
+# of (maybe compressed) data straight out. `start(sync)` is called to begin each
+# new section, `write(buf)` to append to the current section, `copy(offset,
+# size)` to append that range of the file to the current section, and
+# `finish()` once the current section is known to be the last.
+def chunkify(file, compress, zstd, level, max_size, start, write, copy,
+        finish):
+    st = os.fstat(file.fileno())
+    regular = stat.S_ISREG(st.st_mode)
     if compress:
-        compressor = zlib.compressobj()
-    data = b""
-
-    # Read/compress the entire file in chunks.
-    chunk = file.read(CHUNK)
-    while chunk:
-        if compress:
-            data += compressor.compress(chunk)
+        if zstd:
+            compressor = ZstdCompressor(level, st.st_size if regular else -1)
         else:
-            data += chunk
-
-        # While we'd still have data left after processing, do it.
-        while len(data) > max_size:
-            process(data[:max_size], False)
-            data = data[max_size:]
+            compressor = ParallelCompressor(level)
+    # bytes written to the current section.
+    written = 0
+
+    # Writes the output, starting new sections as needed. If this is a
+    # compressed block, the input is also given so that it may be moved to a
+    # new section.
+    def add(out, block=None):
+        nonlocal written
+        room = max_size - written
+        if block is not None and written and len(out) > room \
+                and room <= max_size // SYNC_SLACK:
+            start(True)
+            written = 0
+            out = compressor.unprimed(block)
+        out = memoryview(out)
+        while out:
+            # only start the next section once there's data for it, so that
+            # the last section is never empty.
+            if written == max_size:
+                start(False)
+                written = 0
+            size = min(len(out), max_size - written)
+            write(out[:size])
+            written += size
+            out = out[size:]
 
-        chunk = file.read(CHUNK)
-
-    # Ensure the compressor is flushed.
-    if compress:
-        data += compressor.flush()
-
-    # While we'd still have data left after processing, do it.
-    while len(data) > max_size:
-        process(data[:max_size], False)
-        data = data[max_size:]
+    try:
+        # the first section isn't marked synced, since it always starts the
+        # stream anyway (and this way older versions can still stitch it).
+        start(False)
+        if compress:
+            add(compressor.header)
 
-    # Now do the final section.
-    process(data[:max_size], True)
+        # Read/compress the entire file in chunks. When compressing, the input
+        # is copied into blocks so the same buffer can be read into each time.
+        # Otherwise the chunks are queued to be written as-is, so each needs
+        # its own.
+        if compress:
+            buf = memoryview(bytearray(CHUNK))
+            while (size := file.readinto(buf)):
+                for block, out in compressor.compress(buf[:size]):
+                    add(out, block)
+        elif regular:
+            # the data doesn't need to pass through us at all, so have each
+            # section's worth copied straight across.
+            for offset in range(0, st.st_size, max_size):
+                if offset:
+                    start(False)
+                copy(offset, min(max_size, st.st_size - offset))
+        else:
+            while (chunk := file.read(CHUNK)):
+                add(chunk)
 
+        # Ensure the compressor is flushed.
+        if compress:
+            for block, out in compressor.flush():
+                add(out, block)
+            add(compressor.trailer())
+    finally:
+        if compress:
+            compressor.close()
+
+    finish()
+
+
+def dechunkify(file, decompress, zstd, get_section):
+    # Split the sections into groups which can each be decompressed on their
+    # own, i.e. at every synced section. Note the first section also has the
+    # zlib header, so it always starts a group. Uncompressed sections are all
+    # independant, and zstandard sections are never synced.
+    groups = []
+    while (section := get_section()) is not None:
+        path, header = section
+        if not groups or not decompress or header.sync:
+            groups.append([])
+        groups[-1].append(path)
+
+    # uncompressed sections can just be copied straight across.
+    if not decompress:
+        for paths in groups:
+            for path in paths:
+                with open_for_read(path, ignorable=False) as f:
+                    size = os.fstat(f.fileno()).st_size
+                    copy_range(file, f, Header.SIZE, size - Header.SIZE)
+        return
 
-def dechunkify(file, decompress, get_path):
-    if decompress:
-        decompressor = zlib.decompressobj()
+    # the decompressor of each group, to check the end of the stream. note the
+    # groups run concurrently, so they can't just be tracked as they start.
+    decompressors = [None] * len(groups)
 
-    while (path := get_path()) is not None:
+    # Returns the data of the section.
+    def map_section(path):
+        # map the section instead of reading it, so it's never copied into our
+        # memory. note the mapping stays open until all views of it are
+        # released.
         with open_for_read(path, ignorable=False) as f:
-            # Ignore header.
-            f.seek(Header.SIZE)
+            section = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # have it all read in the background, since we'll need it soon.
+        if hasattr(mmap, "MADV_WILLNEED"):
+            section.madvise(mmap.MADV_WILLNEED)
+        return memoryview(section)[Header.SIZE:]
+
+    def inflate_zstd(paths):
+        # the reader just stops early if the stream was cut short, so first make
+        # sure it's all there. the reader then checks the frame's checksum once
+        # it gets to the end.
+        if not zstd_frame_complete(JoinedReader(map(map_section, paths))):
+            error("section data is corrupt")
+        # zstandard's decompressobj can't bound its output, but reading from a
+        # stream can.
+        data = JoinedReader(map(map_section, paths))
+        reader = zstandard.ZstdDecompressor().stream_reader(data,
+                read_size=CHUNK, closefd=False)
+        while (out := reader.read(CHUNK)):
+            yield out
+
+    def inflate_group(index, paths):
+        if zstd:
+            yield from inflate_zstd(paths)
+            return
+        # after the first group, they're in the middle of the stream so are raw
+        # (no zlib header/trailer).
+        wbits = zlib.MAX_WBITS if index == 0 else -zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits)
+        decompressors[index] = decompressor
+        for path in paths:
+            view = map_section(path)
+            for i in range(0, len(view), CHUNK):
+                chunk = view[i:i + CHUNK]
+                # bound the output of each call, since a chunk can decompress
+                # to far larger than we'd want to hold in memory at once.
+                data = decompressor.decompress(chunk, CHUNK)
+                while data:
+                    yield data
+                    # note the unconsumed tail isn't cleared on reaching the end
+                    # of the stream, and decompressing it again would re-add it
+                    # to the unused data.
+                    if decompressor.eof:
+                        break
+                    data = decompressor.decompress(
+                            decompressor.unconsumed_tail, CHUNK)
+        if not decompressor.eof:
+            yield decompressor.flush()
+
+    # the checksum is normally checked by the decompressor, but not if its been
+    # split into raw groups. then each group checksums its own output, for them
+    # to be combined in order.
+    checksum = len(groups) > 1
+    sums = [None] * len(groups) # (adler32, size) of each group's output.
+    def decompress_group(index, paths):
+        adler = zlib.adler32(b"")
+        size = 0
+        for data in inflate_group(index, paths):
+            if checksum:
+                adler = zlib.adler32(data, adler)
+                size += len(data)
+            yield data
+        sums[index] = (adler, size)
+
+    # Decompress a group per core, each on their own thread. zlib releases the
+    # gil, so these actually run in parallel. The main thread is then just
+    # writing the output, in order.
+    workers = os.cpu_count() or 1
+    running = deque()
+    def start(index):
+        if index < len(groups):
+            gen = decompress_group(index, groups[index])
+            running.append(Prefetch(gen, 4))
+    try:
+        for index in range(workers):
+            start(index)
+        for index in range(len(groups)):
+            with running.popleft() as outputs:
+                for data in outputs:
+                    file.write(data)
+            start(index + workers)
+    finally:
+        for outputs in running:
+            outputs.close()
+
+    # make sure the stream actually finished.
+    if zstd:
+        return
+    last = decompressors[-1]
+    if not last.eof:
+        error("section data is corrupt")
+    if checksum:
+        adler = sums[0][0]
+        for group_adler, size in sums[1:]:
+            adler = adler32_combine(adler, group_adler, size)
+        if read_trailer(groups[-1]) != struct.pack(">I", adler):
+            error("section data is corrupt")
+
+
+# Returns whether the data is exactly one whole zstandard frame, by walking its
+# block headers (without decompressing anything).
+def zstd_frame_complete(data):
+    header = data.peek(18) # the most a frame header can be.
+    try:
+        size = zstandard.frame_header_size(header)
+    except zstandard.ZstdError:
+        return False
+    # the descriptor byte (after the magic) says if a checksum is at the end.
+    checksum = header[4] & 0x04
+    if not data.skip(size):
+        return False
+    # each block header is 3 bytes: [0] = is last, [1:3] = type, [3:24] = size.
+    # rle blocks (type 1) are a single byte, and type 3 is reserved.
+    while True:
+        block = data.peek(3)
+        if len(block) < 3:
+            return False
+        block = int.from_bytes(block, "little")
+        kind = (block >> 1) & 0x3
+        if kind == 3:
+            return False
+        if not data.skip(3 + (1 if kind == 1 else block >> 3)):
+            return False
+        if block & 0x1:
+            break
+    if checksum and not data.skip(4):
+        return False
+    return not data.peek(1)
 
-            chunk = f.read(CHUNK)
-            while chunk:
-                if decompress:
-                    data = decompressor.decompress(chunk)
-                else:
-                    data = chunk
-                file.write(data)
-                chunk = f.read(CHUNK)
 
-    if decompress:
-        file.write(decompressor.flush())
+# Returns the last 4 bytes of the data in the given sections, which may be split
+# across the last few of them. this is the trailer after the end of the (last)
+# raw stream, which isn't always left in the decompressor's `unused_data` (isal
+# drops it).
+def read_trailer(paths):
+    trailer = b""
+    for path in reversed(paths):
+        with open_for_read(path, ignorable=False) as f:
+            size = os.fstat(f.fileno()).st_size - Header.SIZE
+            want = min(4 - len(trailer), size)
+            f.seek(Header.SIZE + size - want)
+            trailer = f.read(want) + trailer
+        if len(trailer) == 4:
+            break
+    return trailer
 
 
 
 
-def split_file(path, size, nest, there, compress, delete_original,
-        only_valid_windows, validate_filenames):
+def split_file(path, size, nest, there, compress, zstd, level,
+        delete_original, only_valid_windows, validate_filenames, quiet):
     path = Path(path)
+    log = noop if quiet else print
 
     # save the original filename to store in the sections.
     filename = path.name
@@ -356,20 +917,23 @@ def split_file(path, size, nest, there, compress, delete_original,
         nameof = lambda i: dirpath / f"{stem}_{i}{EXT}"
     else:
         # Otherwise, check that no sections files already exist for this file.
-        def matching_section_file(p):
-            if not p.is_file():
-                return False
-            if p.suffix != EXT:
+        # only files named like our sections are checked, so that every other
+        # section file in the directory doesn't need its header read.
+        section_name = re.compile(rf"{re.escape(stem)}_\d+{re.escape(EXT)}")
+        def matching_section_file(entry):
+            # check the name first, since scandir gives it for free (and the
+            # file type usually).
+            if not section_name.fullmatch(entry.name) or not entry.is_file():
                 return False
             try:
-                with p.open("rb") as file:
-                    buf = file.read(Header.SIZE)
-                header = Header.read(buf)
+                header = Header.read(read_header(entry.path))
                 return header.name == filename
             except Exception:
                 return False
         parent = path.parent if (there) else Path(".")
-        matching = [p for p in parent.iterdir() if matching_section_file(p)]
+        with os.scandir(parent) as entries:
+            matching = [Path(e.path) for e in entries
+                    if matching_section_file(e)]
         if matching:
             if not ask(f"section files already exist for {esc(path)}, "
                     "overwrite?"):
@@ -379,44 +943,87 @@ def split_file(path, size, nest, there, compress, delete_original,
 
     index = 0
     section_paths = []
+    files = [] # all opened section files, to close on failure.
+    header = None # of the current section.
+
+    # The sections are written on another thread, so that the disk is kept busy
+    # while the next data is being read/compressed. Note every write is queued
+    # in order, so they're all done in order.
+    writer = ThreadPoolExecutor(1)
+    writes = deque() # futures of the queued writes, in order.
+
+    def queue_write(func, *args):
+        writes.append(writer.submit(func, *args))
+        # dont let the unwritten data pile up in memory.
+        while len(writes) > 16:
+            writes.popleft().result()
+
+    def close_section(last):
+        file = files[-1]
+        if last:
+            # only now is it known to be the last, so fix up its header.
+            header.last = True
+            def rewrite():
+                file.seek(0)
+                file.write(header.write())
+            queue_write(rewrite)
+        queue_write(file.close)
 
-    def process(chunk, last):
-        nonlocal index
+    def start(sync):
+        nonlocal index, header
+        if files:
+            close_section(False)
 
         this = nameof(index)
-        header = Header(name=filename, index=index, comp=compress, last=last)
-        with open_for_write(this) as file:
-            try:
-                # print the next one now, but after a possible query of replace.
-                if not last:
-                    print(f"  {esc(nameof(index + 1))}")
-                file.write(header.write())
-                file.write(chunk)
-            finally:
-                # track it to delete if a write fails/keyboard interrupt.
-                section_paths.append(this)
+        log(f"  {esc(this)}")
+        file = open_for_write(this)
+        # track it to delete if a write fails/keyboard interrupt.
+        section_paths.append(this)
+        files.append(file)
+        header = Header(name=filename, index=index, comp=compress, last=False,
+                sync=sync, zstd=zstd)
+        queue_write(file.write, header.write())
         index += 1
 
-    print(f"Splitting {esc(path)} into:")
+    def write(buf):
+        queue_write(files[-1].write, buf)
+
+    def copy(offset, size):
+        queue_write(copy_range, files[-1], file, offset, size)
+
+    def finish():
+        close_section(True)
+
+    log(f"Splitting {esc(path)} into:")
     try:
         with open_for_read(path) as file:
             if file is not NO_EXISTE:
-                # dodgy print re-order to not stall while writing.
-                print(f"  {esc(nameof(0))}")
-                with ask: # context for overwriting existing files.
-                    chunkify(file, compress, size - Header.SIZE, process)
+                with ask_context(): # context for overwriting existing files.
+                    chunkify(file, compress, zstd, level, size - Header.SIZE,
+                            start, write, copy, finish)
+            # copies still need the file open, so finish them first.
+            while writes:
+                writes.popleft().result()
     except: # mostly for keyboard interrupt
+        # abandon the queued writes, making sure nothing is left open.
+        for future in writes:
+            future.cancel()
+        writer.shutdown()
+        for file in files:
+            file.close()
         if nest:
-            delete_paths(dirname)
+            delete_paths(dirpath)
         else:
             delete_paths(*section_paths)
         raise
+    writer.shutdown()
 
     if delete_original:
         delete_paths(path)
 
 
-def stitch_files(paths, keep_sections, keep_dirs):
+def stitch_files(paths, keep_sections, keep_dirs, quiet):
+    log = noop if quiet else print
     if not paths:
         paths = [Path(".")]
         implicit = True
@@ -424,69 +1031,82 @@ def stitch_files(paths, keep_sections, keep_dirs):
         paths = [Path(x) for x in paths]
         implicit = False
 
-    # unpack directories into the subpaths.
-    allpaths = []
+    # directories which section files were taken from.
     dirpaths = []
 
+    # Yields the section file(s) at the path, unpacking directories.
     def unpack(path):
         if not path.exists():
             if not ask(f"path {esc(path)} doesn't exist, ignore?"):
                 error(f"path doesn't exist at: {esc(path)}")
             return
 
+        if path.is_file():
+            yield path
+            return
         if not path.is_dir():
-            allpaths.append(path)
+            if not ask(f"path {esc(path)} is not a file, ignore?"):
+                error(f"file doesn't exist at: {esc(path)}")
             return
 
-        subpaths = [p for p in path.iterdir() if p.is_file() and p.suffix == EXT]
+        # scandir gets the file type along with the listing, so checking is_file
+        # doesn't need another stat per entry.
+        with os.scandir(path) as entries:
+            subpaths = [Path(e.path) for e in entries
+                    if e.name.endswith(EXT) and e.is_file()]
         if implicit:
-            allpaths.extend(subpaths)
+            yield from subpaths
             return
         if subpaths:
-            allpaths.extend(subpaths)
             dirpaths.append(path)
+            yield from subpaths
             return
         if not ask(f"directory {esc(path)} contains no section files, ignore?"):
             error(f"no sections in directory: {esc(path)}")
 
-    with ask: # context for skipping bad paths.
-        for path in paths:
-            unpack(path)
-
-
-    # ensure uniqueness.
-    paths = unique_paths(allpaths)
-
 
     # Collate all the stitches and their section files.
-    @dataclass
+    @dataclass(slots=True)
     class Stitch:
+        # both are keyed by index, until they're checked and then they become
+        # lists in order.
         sections: dict # index -> path
+        headers: dict # index -> header, to not read them again.
         count: int
         comp: bool
+        zstd: bool
     # filename -> Stitch
     stitches = {}
 
-    def register(file):
-        if file is NO_EXISTE:
-            return
-        buf = file.read(Header.SIZE)
+    # Returns the header of the section file, or the exception if it couldn't be
+    # read. Run on a pool, so errors are reported back to `register`.
+    def read_section_header(path):
+        try:
+            return Header.read(read_header(path))
+        except Exception as e:
+            return e
+
+    def register(path, header):
         try:
-            header = Header.read(buf)
+            if isinstance(header, Exception):
+                raise header
             filename = Path(header.name)
 
             if filename in stitches:
                 st = stitches[filename]
-                if header.comp != st.comp:
+                if header.comp != st.comp or header.zstd != st.zstd:
                     raise Exception("inconsistent section compression")
                 if header.index in st.sections:
                     raise Exception("duplicate section file")
                 st.sections[header.index] = path
+                st.headers[header.index] = header
             else:
                 stitches[filename] = Stitch(
                         sections={header.index: path},
+                        headers={header.index: header},
                         count=0,
-                        comp=header.comp)
+                        comp=header.comp,
+                        zstd=header.zstd)
 
             # push the error for multi-last to later. assume the earlier last is
             # correct.
@@ -501,13 +1121,18 @@ def stitch_files(paths, keep_sections, keep_dirs):
                 error(f"{str(e)}: {esc(path)}")
 
     def check(filename, stitch):
-        # Check for extra files, i.e. files after last.
-        extra = [path for index, path in stitch.sections.items()
-                if index >= stitch.count]
+        # Put the sections in order, finding any extra files (i.e. files after
+        # last) along the way.
+        ordered = [None] * stitch.count
+        extra = []
+        for index, path in stitch.sections.items():
+            if index < stitch.count:
+                ordered[index] = path
+            else:
+                extra.append(path)
 
         # Check for missing files, i.e. gaps or never reaches last.
-        missing = not stitch.count or any(index not in stitch.sections.keys()
-                for index in range(stitch.count))
+        missing = not stitch.count or None in ordered
 
         if missing:
             if not ask(f"missing section files for {esc(filename)}, ignore?"):
@@ -518,18 +1143,26 @@ def stitch_files(paths, keep_sections, keep_dirs):
             if not ask(f"unneeded section files for {esc(filename)}, ignore?"):
                 error(f"unneeded sections for: {esc(filename)}, bad sections: "
                         + pathlist(extra))
-            stitch.sections = {index: path
-                    for index, path in stitch.sections.items()
-                    if index < stitch.count}
             # stitch is still completeable.
 
+        if stitch.zstd and zstandard is None:
+            if not ask(f"{esc(filename)} needs zstandard installed, ignore?"):
+                error(f"zstandard must be installed to stitch: {esc(filename)}")
+            return False # we cannot complete this stitch.
+
+        stitch.sections = ordered
+        stitch.headers = [stitch.headers[i] for i in range(stitch.count)]
         return True
 
-    with ask: # context to ignore bad sections.
-        # Register all sections.
-        for path in paths:
-            with open_for_read(path) as file:
-                register(file)
+    with ask_context(): # context to ignore bad paths/sections.
+        # Register all the (unique) sections. the headers are read concurrently,
+        # since it's mostly waiting on the disk for many tiny reads.
+        sections = (sub for path in paths for sub in unpack(path))
+        sections = list(unique_paths(sections))
+        with ThreadPoolExecutor() as pool:
+            headers = pool.map(read_section_header, sections)
+            for path, header in zip(sections, headers):
+                register(path, header)
 
         # Check all the sections are there.
         to_delete = []
@@ -541,23 +1174,24 @@ def stitch_files(paths, keep_sections, keep_dirs):
 
 
     if not stitches:
-        print("Nothing to stitch.")
+        log("Nothing to stitch.")
 
     for filename, st in stitches.items():
-        print(f"Stitching {esc(filename)} from:")
+        log(f"Stitching {esc(filename)} from:")
         index = 0
-        def get_path():
+        def get_section():
             nonlocal index
             if index == st.count:
                 return None
             path = st.sections[index]
+            header = st.headers[index]
             index += 1
-            print(f"  {esc(path)}")
-            return path
+            log(f"  {esc(path)}")
+            return path, header
 
         with open_for_write(filename) as file:
             try:
-                dechunkify(file, st.comp, get_path)
+                dechunkify(file, st.comp, st.zstd, get_section)
             except:
                 # delete the half-baked file before exiting.
                 file.close()
@@ -565,7 +1199,7 @@ def stitch_files(paths, keep_sections, keep_dirs):
                 raise
 
         if not keep_sections:
-            delete_paths(*st.sections.values())
+            delete_paths(*st.sections)
 
     # bit hacked in but if the stitching cleared out any directories remove them.
     if not keep_sections and not keep_dirs:
@@ -596,13 +1230,15 @@ class StitchArgumentParser(argparse.ArgumentParser):
         return super().parse_args(args, namespace)
 
 
+# Longest suffixes first, so "b" doesn't match the end of the others.
+UNITS = (("gb", 1 << 30), ("mb", 1 << 20), ("kb", 1 << 10), ("b", 1))
+
 def parse_size(arg):
     arg = arg.lower()
-    units = {"b": 1, "kb": 1 << 10, "mb": 1 << 20, "gb": 1 << 30}
-    for unit in sorted(units, key=len, reverse=True):
-        if arg.endswith(unit):
-            size = float(arg[:-len(unit)])
-            size *= units[unit]
+    for unit, multiplier in UNITS:
+        if (num := arg.removesuffix(unit)) != arg:
+            size = float(num)
+            size *= multiplier
             size = int(size)
             if size <= 0:
                 raise argparse.ArgumentTypeError(f"size cannot be <= 0: {size}")
@@ -629,6 +1265,9 @@ def main():
     parser.add_argument("-y", "--yes", action="store_true",
             help="automatically say yes to prompts")
 
+    parser.add_argument("-q", "--quiet", action="store_true",
+            help="don't list the files being split/stitched")
+
     parser.add_argument("-s", "--split", action="store_true",
             help="split (instead of stitch) each of the given file(s)")
 
@@ -656,6 +1295,15 @@ def main():
     group_split.add_argument("-f", "--fast", action="store_true",
             help="faster split (does no compression)")
 
+    group_split.add_argument("-z", "--zstd", action="store_true",
+            help="compress with zstandard instead of zlib (requires the "
+                "'zstandard' package)")
+
+    group_split.add_argument("-l", "--level", type=int, metavar="LEVEL",
+            help="compression level, higher is smaller but slower (0 to "
+                f"{zlib.Z_BEST_COMPRESSION}, or 1 to 22 with zstandard, "
+                "defaults to 1)")
+
     group_split.add_argument("-r", "--replace", action="store_true",
             help="delete original file after splitting")
 
@@ -674,14 +1322,19 @@ def main():
 
     args = parser.parse_args()
 
+    # a zero chunk would read nothing and so quietly produce empty output.
+    if CHUNK <= 0:
+        error("STITCH_CHUNK must be a positive number of bytes")
 
     # ensure that splitting/sitching arguments are only given if the mode
     # actually matches. typically this would be done by argparse with a subparser
     # but i didnt wanna use them soo.
     illegal_group = group_stitch if args.split else group_split
-    # cheeky access of all options.
+    # cheeky access of all options. note an option is given if it's not its
+    # default, since a given value may still be falsy (e.g. level 0).
     illegals = [x.option_strings for x in parser._actions
-            if x.container is illegal_group and getattr(args, x.dest)]
+            if x.container is illegal_group
+            and getattr(args, x.dest) is not x.default]
     if illegals:
         illegals = ["/".join(f"'{y}'" for y in x) for x in illegals]
         if len(illegals) <= 2:
@@ -697,11 +1350,30 @@ def main():
     # no files is fine for stitching (handled in `stitch_files`).
 
     if args.yes:
-        ask.always_yes()
+        ask_always_yes()
 
     if not args.size:
         args.size = 8 << 20 # 8MB
 
+    if args.level is not None and args.fast:
+        parser.error("cannot specify a compression level with no compression")
+    if args.zstd and args.fast:
+        parser.error("cannot specify zstandard with no compression")
+    if args.zstd and zstandard is None:
+        parser.error("zstandard is not installed")
+    # each codec has its own range, and zstandard's 0 would be its default
+    # level rather than the fastest.
+    if args.zstd:
+        levels = range(1, zstandard.MAX_COMPRESSION_LEVEL + 1)
+    else:
+        levels = range(zlib.Z_BEST_COMPRESSION + 1)
+    if args.level is not None and args.level not in levels:
+        parser.error(f"compression level must be {levels.start} to "
+                f"{levels.stop - 1}")
+    if args.level is None:
+        # favour speed, the size gain of higher levels is rarely worth it.
+        args.level = 1
+
     if args.size <= Header.SIZE:
         error(f"cannot encode any data without at-least {Header.SIZE + 1} byte "
                 "sections")
@@ -726,19 +1398,21 @@ def main():
 
     # remove duplicate paths. note this is mostly done to ensure consistency
     # between glob and no glob.
-    paths = unique_paths(paths)
+    paths = list(unique_paths(paths))
 
 
     # Do the thing.
     if args.split:
         for path in paths:
             split_file(path, size=args.size, nest=args.nest, there=args.there,
-                    compress=not args.fast, delete_original=args.replace,
+                    compress=not args.fast, zstd=args.zstd, level=args.level,
+                    delete_original=args.replace,
                     only_valid_windows=not args.unix_filenames,
-                    validate_filenames=not args.all_filenames)
+                    validate_filenames=not args.all_filenames,
+                    quiet=args.quiet)
     else:
         stitch_files(paths, keep_sections=args.keep_sections,
-                keep_dirs=args.keep_dirs)
+                keep_dirs=args.keep_dirs, quiet=args.quiet)
 
 
 if __name__ == "__main__":